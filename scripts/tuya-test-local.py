@@ -8,7 +8,10 @@ Edit the DEVICE_CONFIG section with your device's info.
 
 import tinytuya
 import json
+import select
+import socket
 import sys
+import time
 from datetime import datetime
 
 # ╔════════════════════════════════════════════════════════════╗
@@ -26,14 +29,47 @@ DEVICE_CONFIG = {
 # ║  FUNCTIONS                                                 ║
 # ╚════════════════════════════════════════════════════════════╝
 
+def probe_device(address, port=6668, timeout=0.2):
+    """Quick non-blocking TCP probe of the Tuya local port.
+
+    device.status() blocks for the full socket timeout (5s) when the device
+    is unreachable; this fails in ~200ms instead so bad IPs/offline plugs
+    don't hang the script.
+    """
+    s = socket.socket()
+    try:
+        s.setblocking(False)
+        s.connect_ex((address, port))
+        ready = select.select([], [s], [], timeout)[1]
+        if not ready:
+            return False
+        # Writable only means the connect attempt finished — a refused
+        # connection is writable too, so check the socket error as well
+        return s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+    finally:
+        s.close()
+
 def test_connection():
-    """Test if we can connect to the device"""
+    """Test if we can connect to the device.
+
+    Returns the connected OutletDevice on success (so test_control can reuse
+    the session instead of redoing the local-key handshake), None on failure.
+    """
     print("╔════════════════════════════════════════════════════════════╗")
     print("║         TUYA LOCAL CONTROL TEST                           ║")
     print("╚════════════════════════════════════════════════════════════╝\n")
 
     print(f"Testing connection to device at {DEVICE_CONFIG['address']}...\n")
 
+    # Fast-fail before paying the 5s tinytuya socket timeout
+    if not probe_device(DEVICE_CONFIG['address']):
+        print("❌ Device not reachable on port 6668 (200ms probe)")
+        print("\nTROUBLESHOOTING:")
+        print("1. Check device IP address is correct")
+        print("2. Ensure device is powered on")
+        print("3. Check firewall isn't blocking port 6668")
+        return None
+
     device = tinytuya.OutletDevice(
         dev_id=DEVICE_CONFIG['dev_id'],
         address=DEVICE_CONFIG['address'],
@@ -56,7 +92,7 @@ def test_connection():
             print("2. Ensure device is powered on")
             print("3. Verify local key is correct")
             print("4. Check firewall isn't blocking ports 6666, 6667")
-            return False
+            return None
 
         print("✓ Device responded!\n")
 
@@ -104,7 +140,7 @@ def test_connection():
 
         print("✓ LOCAL CONTROL WORKING!")
         print("\nYou can now integrate this into your app.")
-        return True
+        return device
 
     except Exception as e:
         print(f"❌ Error: {str(e)}\n")
@@ -113,21 +149,14 @@ def test_connection():
         print("2. Check network connectivity")
         print("3. Ensure local key hasn't changed")
         print("4. Try rescanning: python -m tinytuya scan")
-        return False
+        return None
 
-def test_control():
-    """Test turning device on/off"""
+def test_control(device):
+    """Test turning device on/off (reuses the device from test_connection)"""
     print("\n" + "="*60)
     print("TESTING DEVICE CONTROL")
     print("="*60 + "\n")
 
-    device = tinytuya.OutletDevice(
-        dev_id=DEVICE_CONFIG['dev_id'],
-        address=DEVICE_CONFIG['address'],
-        local_key=DEVICE_CONFIG['local_key'],
-        version=DEVICE_CONFIG['version']
-    )
-
     try:
         print("Attempting to toggle device...")
 
@@ -144,22 +173,25 @@ def test_control():
         new_state = not current_state
         print(f"Turning {'ON' if new_state else 'OFF'}...")
 
+        # tinytuya returns the updated DPs in the command response itself,
+        # so verification doesn't need a second status() round-trip
         if new_state:
-            device.turn_on()
+            result = device.turn_on()
         else:
-            device.turn_off()
-
-        # Wait and verify
-        import time
-        time.sleep(2)
-
-        status = device.status()
-        if status and 'dps' in status:
-            actual_state = status['dps'].get('1', False)
-            if actual_state == new_state:
-                print(f"✓ Successfully turned {'ON' if new_state else 'OFF'}!")
-            else:
-                print(f"⚠️  State may not have changed")
+            result = device.turn_off()
+
+        dps = (result or {}).get('dps')
+        if dps is None:
+            # Some firmwares ack without DPs; fall back to one quick read
+            time.sleep(0.2)
+            status = device.status()
+            dps = status.get('dps', {}) if status else {}
+
+        actual_state = dps.get('1', False)
+        if actual_state == new_state:
+            print(f"✓ Successfully turned {'ON' if new_state else 'OFF'}!")
+        else:
+            print(f"⚠️  State may not have changed")
 
     except Exception as e:
         print(f"❌ Control error: {str(e)}")
@@ -179,12 +211,19 @@ if __name__ == '__main__':
         print("  - version (usually 3.3)\n")
         sys.exit(1)
 
-    # Run test
-    if test_connection():
-        # Ask if user wants to test control
-        response = input("\nTest device control (turn on/off)? [y/N]: ")
-        if response.lower() == 'y':
-            test_control()
+    # Run test — keep one device session open for both phases so the
+    # local-key handshake only happens once
+    device = None
+    try:
+        device = test_connection()
+        if device:
+            # Ask if user wants to test control
+            response = input("\nTest device control (turn on/off)? [y/N]: ")
+            if response.lower() == 'y':
+                test_control(device)
+    finally:
+        if device:
+            device.close()
 
     print("\n" + "="*60)
     print("Test complete!")
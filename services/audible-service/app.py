@@ -0,0 +1,613 @@
+#!/usr/bin/env python3
+"""
+Audible Service
+
+Async sidecar that proxies the Audible API for the tracker app. Runs as an
+ASGI app (FastAPI + uvicorn) so concurrent requests don't serialize behind a
+single blocking worker — every endpoint spends almost all of its time waiting
+on Audible's HTTPS responses.
+
+Audible client instances are reused across requests (keyed by token hash +
+country) so the TCP/TLS handshake is paid once per user session instead of
+once per call.
+
+Endpoints:
+    GET  /health                  - liveness check
+    POST /api/authenticate        - Audible login, returns encrypted tokens
+    POST /api/library             - full library with listening progress
+    POST /api/progress/{asin}     - progress for a single book
+    POST /api/refresh-token       - exchange refresh token for new access token
+
+All /api/* routes require the X-API-Secret header.
+"""
+
+import asyncio
+import base64
+import functools
+import hashlib
+import hmac
+import logging
+import math
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from operator import itemgetter
+from types import MappingProxyType
+
+import audible
+import httpx
+import numpy as np
+import orjson
+import uvicorn
+from audible.exceptions import Unauthorized
+from audible.localization import Locale
+from cachetools import TTLCache
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PORT = int(os.getenv("PORT", "5001"))
+API_SECRET = os.getenv("AUDIBLE_API_SECRET", "")
+
+# Tokens are encrypted at rest on the Next.js side; both ends share this key.
+ENCRYPTION_KEY = os.getenv("AUDIBLE_ENCRYPTION_KEY", "").encode() or Fernet.generate_key()
+cipher_suite = Fernet(ENCRYPTION_KEY)
+
+# New tokens are sealed with AES-GCM directly (reusing the encryption half of
+# the Fernet key) — same confidentiality+integrity, minus Fernet's per-call
+# timestamp and double base64 round-trip. Fernet stays around so tokens
+# issued before the switch keep decrypting.
+_aesgcm = AESGCM(base64.urlsafe_b64decode(ENCRYPTION_KEY)[16:])
+
+# orjson encodes the ~flat book dicts several times faster than stdlib json;
+# for a 500-book library the payload is a few hundred KB, so serialization is
+# worth taking off the response path.
+class AppJSONResponse(ORJSONResponse):
+    """ORJSONResponse that renders naive datetimes as UTC with a Z suffix,
+    so handlers can hand expiry datetimes straight to the encoder instead of
+    building isoformat strings themselves."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z)
+
+
+# The service has exactly one caller (the Next.js app), so the CORS decision
+# is a constant — precompute the header bytes once instead of re-deriving the
+# origin logic per request the way CORSMiddleware does.
+_CORS_HEADERS = [
+    (b"access-control-allow-origin", os.getenv("CORS_ORIGIN", "*").encode()),
+    (b"access-control-allow-headers", b"X-API-Secret,Content-Type"),
+    (b"access-control-allow-methods", b"POST,GET,OPTIONS"),
+]
+
+
+class CORSHeaderMiddleware:
+    """Minimal ASGI middleware that appends the precomputed CORS headers and
+    short-circuits preflight OPTIONS with an empty 204."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS":
+            await send({
+                "type": "http.response.start",
+                "status": 204,
+                "headers": list(_CORS_HEADERS),
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message["headers"]) + _CORS_HEADERS
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+_API_SECRET_B = API_SECRET.encode()
+
+
+class APISecretMiddleware:
+    """One constant-time secret gate for every /api route.
+
+    Replaces per-route equality checks: compare_digest doesn't leak timing
+    the way == does, and centralising the guard keeps it off each handler's
+    signature."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and _API_SECRET_B and scope["path"].startswith("/api/"):
+            secret = b""
+            for name, value in scope["headers"]:
+                if name == b"x-api-secret":
+                    secret = value
+                    break
+            if not hmac.compare_digest(secret, _API_SECRET_B):
+                await send({
+                    "type": "http.response.start",
+                    "status": 401,
+                    "headers": [(b"content-type", b"application/json")],
+                })
+                await send({
+                    "type": "http.response.body",
+                    "body": b'{"detail":"Invalid API secret"}',
+                })
+                return
+        await self.app(scope, receive, send)
+
+
+app = FastAPI(title="Audible Service", default_response_class=AppJSONResponse)
+# CORS added last so it wraps the secret gate (preflight OPTIONS carries no
+# secret header and must short-circuit first).
+app.add_middleware(APISecretMiddleware)
+app.add_middleware(CORSHeaderMiddleware)
+
+# One shared transport for all outgoing Audible traffic: HTTP/2 multiplexes
+# the paginated library fan-out onto a single connection, TCP_NODELAY avoids
+# Nagle delays on the small request frames, and the 4 MiB buffers keep large
+# library pages from stalling on the default window. Sharing the transport
+# also shares its SSL context, so TLS session resumption kicks in from the
+# second connection onward.
+_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024),
+    (socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024),
+]
+_transport = httpx.AsyncHTTPTransport(
+    http2=True,
+    retries=2,
+    limits=httpx.Limits(max_keepalive_connections=64, keepalive_expiry=300),
+    socket_options=_SOCKET_OPTIONS,
+)
+
+# Live audible.AsyncClient per (access-token hash, country). Each cached
+# client carries its already-decrypted Authenticator, so a hit skips both
+# token decrypts and the signer rebuild entirely — tokens are only ever
+# decrypted on the first request of a session. Reusing the client also
+# amortises connection setup across the library/progress/refresh calls a
+# user makes within a token lifetime. TTL is 55 min, just under the 1 h
+# Audible token lifetime; stale entries age out on their own, and an
+# Unauthorized from Audible evicts early so the next call rebuilds fresh.
+_client_cache: TTLCache = TTLCache(maxsize=512, ttl=3300)
+_clients_lock = asyncio.Lock()
+_client_cache_hits = 0
+_client_cache_misses = 0
+
+# Transformed library responses, keyed like the client cache. The library is
+# idempotent for minutes at a time while the frontend polls it, so most calls
+# become a dict lookup instead of an Audible round-trip. Per-worker (in
+# process) by design — a stale worker just refreshes independently.
+# Entries are (books, by_asin index, monotonic fetch time); the index lets
+# /api/progress answer from a recent library fetch without its own call.
+_library_cache: TTLCache = TTLCache(maxsize=4096, ttl=300)
+_library_cache_lock = asyncio.Lock()
+
+# Progress is more volatile than the rest of the library payload, so the
+# short-circuit only trusts cached entries younger than this.
+_PROGRESS_CACHE_MAX_AGE = 30
+
+# Lets the Next.js fetch drop cache: 'no-store' and reuse responses briefly.
+_LIBRARY_CACHE_CONTROL = "private, max-age=60, stale-while-revalidate=300"
+
+
+# Library pagination: 50-item pages fetched concurrently instead of one big
+# blocking GET, capped so a large library can't open unbounded connections
+# (and trip Audible's 429 throttling).
+_LIBRARY_PAGE_SIZE = 50
+_library_fetch_semaphore = asyncio.Semaphore(8)
+
+# Singleflight for /api/library: N identical requests in flight (multiple
+# tabs polling) collapse onto one upstream fetch with N awaiters. The global
+# semaphore additionally bounds how many distinct library fetches can hit
+# Audible at once across all users.
+_inflight: dict = {}
+_inflight_lock = asyncio.Lock()
+_upstream_semaphore = asyncio.Semaphore(16)
+
+# Frozen request params, built once: the handlers just splat a constant
+# mapping instead of rebuilding the same kwargs dict on every call.
+_LIBRARY_PARAMS = MappingProxyType({
+    "num_results": _LIBRARY_PAGE_SIZE,
+    "response_groups": "product_desc,product_attrs,media,last_position_heard",
+    "sort_by": "PurchaseDate",
+})
+_PROGRESS_PARAMS = MappingProxyType({
+    "response_groups": "media,last_position_heard",
+})
+
+
+class AuthRequest(BaseModel):
+    email: str
+    password: str
+    country_code: str = "us"
+
+
+class TokenRequest(BaseModel):
+    access_token: str
+    refresh_token: str
+    country_code: str = "us"
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+    # The (possibly expired) access token, if the caller still has one; the
+    # audible validators require an Atna|-shaped token to build an
+    # Authenticator, and refreshing replaces it anyway.
+    access_token: str = ""
+    country_code: str = "us"
+
+
+def encrypt_fast(data: bytes) -> str:
+    nonce = os.urandom(12)
+    return base64.urlsafe_b64encode(nonce + _aesgcm.encrypt(nonce, data, None)).decode()
+
+
+def decrypt(token: str) -> str:
+    try:
+        raw = base64.urlsafe_b64decode(token.encode())
+        return _aesgcm.decrypt(raw[:12], raw[12:], None).decode()
+    except Exception:
+        pass
+    try:
+        # Fernet-era token from before the AES-GCM switch.
+        return cipher_suite.decrypt(token.encode()).decode()
+    except Exception:
+        # Malformed base64, wrong key, or truncated ciphertext — the caller
+        # sent a token we can't use, not a server error.
+        raise HTTPException(status_code=401, detail="Invalid or corrupted token")
+
+
+@functools.lru_cache(maxsize=32)
+def _locale(country_code: str) -> Locale:
+    """Locale objects are constant per country; building one parses the
+    audible locale table, so memoize the handful of valid codes."""
+    return Locale(country_code)
+
+
+def _build_authenticator(access_token: str, refresh_token: str, country_code: str) -> audible.Authenticator:
+    """Rebuild an Authenticator from the decrypted token pair."""
+    return audible.Authenticator.from_dict({
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "locale_code": country_code,
+        "expires": (datetime.utcnow() + timedelta(hours=1)).timestamp(),
+    })
+
+
+def _client_key(access_token_enc: str, country_code: str) -> tuple[bytes, str]:
+    """Cache key: hash of the *encrypted* access token so we never keep
+    plaintext tokens around as dict keys."""
+    return (hashlib.blake2b(access_token_enc.encode(), digest_size=16).digest(),
+            country_code)
+
+
+async def create_audible_client(access_token_enc: str, refresh_token_enc: str,
+                                country_code: str) -> audible.AsyncClient:
+    """Return a ready-to-use AsyncClient, reusing one if we already built it."""
+    global _client_cache_hits, _client_cache_misses
+    key = _client_key(access_token_enc, country_code)
+    async with _clients_lock:
+        client = _client_cache.get(key)
+        if client is None:
+            _client_cache_misses += 1
+            auth = _build_authenticator(
+                decrypt(access_token_enc),
+                decrypt(refresh_token_enc),
+                country_code,
+            )
+            client = audible.AsyncClient(auth=auth)
+            # Route the client's httpx session over the shared tuned transport.
+            client.session._transport = _transport
+            _client_cache[key] = client
+        else:
+            _client_cache_hits += 1
+    return client
+
+
+async def evict_audible_client(access_token_enc: str, country_code: str) -> None:
+    """Drop a cached client (e.g. after a 401) so the next call rebuilds it."""
+    async with _clients_lock:
+        _client_cache.pop(_client_key(access_token_enc, country_code), None)
+
+
+# Transform helpers hoisted to module scope: the per-book loop runs hundreds
+# of times per library fetch, so bound-method lookups are kept out of it.
+_NAME = itemgetter("name")
+_EMPTY: dict = {}
+
+# Below this many items the fixed cost of building NumPy arrays outweighs the
+# C-loop win; compute the percentages per book in Python instead.
+_NUMPY_MIN_ITEMS = 64
+
+
+def _runtime_minutes(item: dict) -> int:
+    product = item.get("product", _EMPTY)
+    return product.get("runtime_length_min") or product.get("runtime_length_sec", 0) // 60
+
+
+def _position_seconds(item: dict) -> int:
+    return item.get("last_position_heard", _EMPTY).get("position_ms", 0) // 1000
+
+
+def _percent_complete_vector(items: list) -> np.ndarray:
+    """Vectorized progress-percent pass over the whole library."""
+    n = len(items)
+    runtime = np.fromiter(map(_runtime_minutes, items), dtype=np.int64, count=n)
+    pos = np.fromiter(map(_position_seconds, items), dtype=np.int64, count=n)
+    return np.minimum(
+        100, np.where(runtime > 0, (pos * 100) // np.maximum(runtime * 60, 1), 0)
+    )
+
+
+def _transform_book(item: dict, percent_complete: int | None = None) -> dict:
+    iget = item.get
+    product = iget("product", _EMPTY)
+    pget = product.get
+
+    runtime_min = _runtime_minutes(item)
+    position_sec = _position_seconds(item)
+
+    if percent_complete is None:
+        percent_complete = 0
+        if runtime_min > 0:
+            percent_complete = min(100, (position_sec * 100) // (runtime_min * 60))
+
+    return {
+        "asin": pget("asin") or iget("asin", ""),
+        "title": pget("title", ""),
+        "subtitle": pget("subtitle", ""),
+        "authors": list(map(_NAME, pget("authors", ()))),
+        "narrators": list(map(_NAME, pget("narrators", ()))),
+        "runtime_minutes": runtime_min,
+        "release_date": pget("release_date", ""),
+        "purchase_date": iget("purchase_date", ""),
+        "cover_url": pget("product_images", _EMPTY).get("500", ""),
+        "position_seconds": position_sec,
+        "percent_complete": percent_complete,
+        "is_finished": iget("is_finished", False) or percent_complete >= 100,
+    }
+
+
+async def _fetch_library_page(client: audible.AsyncClient, page: int) -> dict:
+    async with _library_fetch_semaphore:
+        return await client.get("library", page=page, **_LIBRARY_PARAMS)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "healthy", "service": "audible-service"}
+
+
+@app.get("/metrics")
+async def metrics():
+    return {
+        "client_cache_hits": _client_cache_hits,
+        "client_cache_misses": _client_cache_misses,
+        "client_cache_size": len(_client_cache),
+    }
+
+
+@app.post("/api/authenticate")
+async def authenticate(body: AuthRequest):
+    logger.info("Authenticating user: %s (country: %s)", body.email, body.country_code)
+    locale = _locale(body.country_code)
+
+    try:
+        # from_login is blocking (full Amazon login flow); keep it off the loop.
+        auth = await asyncio.to_thread(
+            audible.Authenticator.from_login,
+            body.email,
+            body.password,
+            locale=locale,
+            with_username=False,
+        )
+    except Exception as e:
+        logger.error("Authentication failed for %s: %s", body.email, e)
+        raise HTTPException(status_code=401, detail="Audible authentication failed")
+
+    # Plain datetime, returned as an explicit AppJSONResponse: FastAPI's
+    # jsonable_encoder would stringify it (without the Z) before orjson ever
+    # saw it, so the handler builds the response itself like get_library does.
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+    return AppJSONResponse({
+        "success": True,
+        "access_token": encrypt_fast(auth.access_token.encode()),
+        "refresh_token": encrypt_fast(auth.refresh_token.encode()),
+        "adp_token": encrypt_fast((auth.adp_token or "").encode()),
+        "expires_at": expires_at,
+    })
+
+
+async def _fetch_library_books(body: TokenRequest, cache_key) -> list:
+    """Fetch, transform, and cache the full library for one user."""
+    logger.info("Fetching library for country: %s", body.country_code)
+    client = await create_audible_client(body.access_token, body.refresh_token, body.country_code)
+
+    try:
+        async with _upstream_semaphore:
+            # First page tells us total_results; remaining pages fetch in
+            # parallel, so wall time is max(page latency) instead of the sum.
+            first = await _fetch_library_page(client, 1)
+            items = first.get("items", [])
+            total = first.get("total_results", len(items))
+            pages = math.ceil(total / _LIBRARY_PAGE_SIZE)
+            if pages > 1:
+                results = await asyncio.gather(
+                    *(_fetch_library_page(client, p) for p in range(2, pages + 1))
+                )
+                for page_result in results:
+                    items.extend(page_result.get("items", []))
+    except Unauthorized:
+        await evict_audible_client(body.access_token, body.country_code)
+        async with _library_cache_lock:
+            _library_cache.pop(cache_key, None)
+        raise HTTPException(status_code=401, detail="Audible token expired")
+    except Exception as e:
+        logger.error("Library fetch failed: %s", e)
+        raise HTTPException(status_code=502, detail="Audible library fetch failed")
+
+    if len(items) >= _NUMPY_MIN_ITEMS:
+        percents = _percent_complete_vector(items)
+        books = [_transform_book(item, int(pct)) for item, pct in zip(items, percents)]
+    else:
+        books = [_transform_book(item) for item in items]
+
+    async with _library_cache_lock:
+        _library_cache[cache_key] = (
+            books,
+            {b["asin"]: b for b in books},
+            time.monotonic(),
+        )
+
+    logger.info("Fetched %d books from Audible library", len(books))
+    return books
+
+
+@app.post("/api/library")
+async def get_library(body: TokenRequest):
+    cache_key = _client_key(body.access_token, body.country_code)
+
+    while True:
+        async with _library_cache_lock:
+            cached = _library_cache.get(cache_key)
+        if cached is not None:
+            books = cached[0]
+            break
+
+        # Coalesce duplicate in-flight fetches: the first request for a key
+        # does the upstream work, later arrivals just await its future.
+        async with _inflight_lock:
+            fut = _inflight.get(cache_key)
+            leader = fut is None
+            if leader:
+                fut = asyncio.get_running_loop().create_future()
+                _inflight[cache_key] = fut
+
+        if leader:
+            try:
+                books = await _fetch_library_books(body, cache_key)
+            except asyncio.CancelledError:
+                # Our client went away — cancel the shared future so a
+                # follower loops around and takes over as leader, rather
+                # than failing everyone with our cancellation.
+                fut.cancel()
+                raise
+            except BaseException as e:
+                fut.set_exception(e)
+                fut.exception()  # mark retrieved in case no one else is waiting
+                raise
+            else:
+                fut.set_result(books)
+            finally:
+                async with _inflight_lock:
+                    _inflight.pop(cache_key, None)
+            break
+
+        try:
+            # shield: a follower being cancelled must not cancel the shared
+            # future out from under the other awaiters.
+            books = await asyncio.shield(fut)
+            break
+        except asyncio.CancelledError:
+            if fut.cancelled():
+                continue  # leader was cancelled; retry (and maybe lead)
+            raise
+
+    return AppJSONResponse(
+        {"success": True, "books": books, "total": len(books)},
+        headers={"Cache-Control": _LIBRARY_CACHE_CONTROL},
+    )
+
+
+@app.post("/api/progress/{asin}")
+async def get_progress(asin: str, body: TokenRequest):
+    # A fresh library fetch already carries this book's progress; answer from
+    # the index instead of a dedicated Audible round-trip when it's recent.
+    cache_key = _client_key(body.access_token, body.country_code)
+    async with _library_cache_lock:
+        cached = _library_cache.get(cache_key)
+    if cached is not None and time.monotonic() - cached[2] <= _PROGRESS_CACHE_MAX_AGE:
+        book = cached[1].get(asin)
+        if book is not None:
+            return {
+                "success": True,
+                "asin": asin,
+                "position_seconds": book["position_seconds"],
+                "percent_complete": book["percent_complete"],
+                "is_finished": book["is_finished"],
+            }
+
+    logger.info("Fetching progress for ASIN: %s", asin)
+    client = await create_audible_client(body.access_token, body.refresh_token, body.country_code)
+
+    try:
+        result = await client.get(f"library/{asin}", **_PROGRESS_PARAMS)
+    except Unauthorized:
+        await evict_audible_client(body.access_token, body.country_code)
+        raise HTTPException(status_code=401, detail="Audible token expired")
+    except Exception as e:
+        logger.error("Progress fetch failed for %s: %s", asin, e)
+        raise HTTPException(status_code=502, detail="Audible progress fetch failed")
+
+    item = result.get("item", {})
+    product = item.get("product", {})
+    last_position = item.get("last_position_heard", {})
+
+    runtime_min = product.get("runtime_length_min", 0)
+    position_sec = last_position.get("position_ms", 0) // 1000
+    percent_complete = 0
+    if runtime_min > 0:
+        percent_complete = min(100, int((position_sec / (runtime_min * 60)) * 100))
+
+    return {
+        "success": True,
+        "asin": asin,
+        "position_seconds": position_sec,
+        "percent_complete": percent_complete,
+        "is_finished": item.get("is_finished", False) or percent_complete >= 100,
+    }
+
+
+@app.post("/api/refresh-token")
+async def refresh_token(body: RefreshRequest):
+    logger.info("Refreshing token for country: %s", body.country_code)
+    # from_dict rejects empty access tokens (^Atna\|.* validator), so pass
+    # the caller's expired token through when we have it and a validator-
+    # shaped placeholder otherwise; refresh_access_token overwrites it.
+    access_token = decrypt(body.access_token) if body.access_token else "Atna|expired"
+    auth = _build_authenticator(access_token, decrypt(body.refresh_token), body.country_code)
+
+    try:
+        await asyncio.to_thread(auth.refresh_access_token)
+    except Exception as e:
+        logger.error("Token refresh failed: %s", e)
+        raise HTTPException(status_code=401, detail="Token refresh failed")
+
+    # Plain datetime, returned as an explicit AppJSONResponse: FastAPI's
+    # jsonable_encoder would stringify it (without the Z) before orjson ever
+    # saw it, so the handler builds the response itself like get_library does.
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+    return AppJSONResponse({
+        "success": True,
+        "access_token": encrypt_fast(auth.access_token.encode()),
+        "expires_at": expires_at,
+    })
+
+
+if __name__ == "__main__":
+    # Dev only — production runs via start.sh (uvicorn, one worker per core,
+    # uvloop + httptools).
+    uvicorn.run(app, host="0.0.0.0", port=PORT)
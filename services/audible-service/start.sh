@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# Production entrypoint: multiple async uvicorn workers so concurrent
+# Audible calls don't queue behind a single process. Dev still uses
+# `python app.py`.
+exec uvicorn app:app \
+  --host 0.0.0.0 \
+  --port "${PORT:-5001}" \
+  --workers "${WEB_CONCURRENCY:-$(nproc)}" \
+  --loop uvloop \
+  --http httptools
@@ -0,0 +1,21 @@
+"""Smoke tests: the service module imports cleanly and /health responds.
+
+Run with `pytest` from this directory; skips if the service deps aren't
+installed.
+"""
+
+import pytest
+
+pytest.importorskip("audible")
+pytest.importorskip("fastapi")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import app as audible_service  # noqa: E402
+
+
+def test_health():
+    client = TestClient(audible_service.app)
+    resp = client.get("/health")
+    assert resp.status_code == 200
+    assert resp.json() == {"status": "healthy", "service": "audible-service"}